@@ -1,12 +1,30 @@
 # app.py
+import csv
+import io
+import json
 import os
-import sqlite3
-from datetime import datetime, timedelta
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 
 from functools import wraps
-from flask import Flask, request, jsonify, render_template, Response
-
-app = Flask(__name__)
+import click
+from flask import (
+    Blueprint, Flask, Response, current_app, g, jsonify, render_template, request, send_file,
+)
+from werkzeug.local import LocalProxy
+
+from cache import PremiumCache, TTLCache
+from hll import HyperLogLog, DEFAULT_PRECISION
+from profiling import (
+    RequestProfile, explain_all, is_profile_requested, load_profile, load_report,
+    profile_signature,
+)
+from storage import PING_COLUMNS, create_storage, sketch_bucket_start
+
+# ルートは Blueprint に載せて、create_app() で Flask アプリに登録する
+bp = Blueprint("hereping", __name__, cli_group=None)
 
 # Basic認証用のチェック関数
 def check_auth(username: str, password: str) -> bool:
@@ -38,83 +56,134 @@ ADMIN_SECRET = os.environ.get("ADMIN_SECRET", "dev-secret")
 # v1で許可するステータス
 ALLOWED_STATUS = {"awake", "free", "cantSleep", "working"}
 
-# --- DB 周り ----------------------------------------------------
-
-# pings_v2.db をこのファイルと同じディレクトリに作る
-DB_PATH = os.path.join(os.path.dirname(__file__), "pings_v2.db")
-
-
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
-
-    # --- pings テーブル（既存） ---
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT,
-            status TEXT,
-            region_code TEXT,
-            city_name TEXT,
-            area_code TEXT,
-            lat REAL,
-            lng REAL,
-            message TEXT,
-            created_at TEXT
-        )
-        """
-    )
+# エリアごとの地図表示用の代表点（region シャードのキーにも使う）
+REGION_CENTER = {
+    "hokkaido_tohoku": {"lat": 39.7, "lng": 141.0, "label": "北海道・東北"},
+    "kanto":           {"lat": 35.7, "lng": 139.7, "label": "関東"},
+    "chubu":           {"lat": 36.2, "lng": 137.9, "label": "中部"},
+    "kansai":          {"lat": 34.7, "lng": 135.5, "label": "関西"},
+    "chugoku_shikoku": {"lat": 34.3, "lng": 133.0, "label": "中国・四国"},
+    "kyushu_okinawa":  {"lat": 32.0, "lng": 130.7, "label": "九州・沖縄"},
+    # World はパリ近辺とか、どこか確実に陸の場所にしておく
+    "world_other":     {"lat": 48.85, "lng": 2.35, "label": "World"},
+}
 
-    # --- ★ 追加：プレミアム端末テーブル ---
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS premium_devices (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_id TEXT UNIQUE,
-            is_premium INTEGER NOT NULL DEFAULT 0,
-            note TEXT,
-            created_at TEXT,
-            updated_at TEXT
-        )
-        """
-    )
+# --- DB 周り ----------------------------------------------------
 
-    conn.commit()
-    conn.close()
+# pings_v2.db をこのファイルと同じディレクトリに作る（DB_PATH で上書き可）
+DB_PATH = os.environ.get(
+    "DB_PATH", os.path.join(os.path.dirname(__file__), "pings_v2.db")
+)
+
+# ストレージエンジン: "sqlite"（デフォルト） / "memory"（テスト・ベンチ用、ディスクI/Oなし）
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "sqlite").strip().lower()
+
+# --- シャーディング（任意・sqlite のみ） ---
+# SQLite は1ファイル1ライターなので、書き込みを増やしたいときは pings を複数ファイルに分ける。
+#   SHARD_MODE=""        … 従来どおり pings_v2.db 1本（デフォルト）
+#   SHARD_MODE="region"  … region_code ごとに pings_v2_<region>.db（REGION_CENTER のキー + other）
+#   SHARD_MODE="device"  … device_id のハッシュで pings_v2_d0.db〜d{SHARD_COUNT-1}.db
+# ※ 切り替えても既存の pings_v2.db の pings はシャードへ移さない（移すなら export-pings で出して入れ直す）
+SHARD_MODE = os.environ.get("SHARD_MODE", "").strip().lower()
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "4"))
+
+# --- キャッシュ（秒） ---
+# 直近N分・全期間の集計は数秒古くてもよいので、ワーカー内で使い回す（0 で無効）
+AGGREGATE_CACHE_TTL = float(os.environ.get("AGGREGATE_CACHE_TTL", "5"))
+# プレミアム端末の集合は TTL ではなく storage.premium_version() で作り直す（cache.PremiumCache）
+
+# --- プロファイル ---
+# 抜き取りでプロファイルする割合（0〜1、0 で無効）。署名付きリクエストはこれと関係なく取る
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# .prof / .json の置き場所
+PROFILE_DIR = os.environ.get(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "hereping_profiles")
+)
+# 抜き取り分は直近 PROFILE_WINDOW_HOURS 時間のうち遅い順に PROFILE_KEEP 件残す
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_WINDOW_HOURS = float(os.environ.get("PROFILE_WINDOW_HOURS", "24"))
+# 署名付き分は別枠で新しい順に PROFILE_KEEP_SIGNED 件
+PROFILE_KEEP_SIGNED = int(os.environ.get("PROFILE_KEEP_SIGNED", "20"))
+
+# create_app() で作ったものを current_app.extensions から引く
+storage = LocalProxy(lambda: current_app.extensions["hereping.storage"])
+premium_cache = LocalProxy(lambda: current_app.extensions["hereping.premium_cache"])
+aggregate_cache = LocalProxy(lambda: current_app.extensions["hereping.aggregate_cache"])
 
 
 def is_premium_device(device_id: str) -> bool:
     """device_id がプレミアムかどうかを返す（なければ False）"""
     if not device_id:
         return False
+    return premium_cache.is_premium(device_id)
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT is_premium FROM premium_devices WHERE device_id = ?",
-        (device_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
 
-    if not row:
-        return False
-    return bool(row[0])
+def window_counts(columns, minutes=None, with_location=False):
+    """
+    直近 minutes 分（None なら全期間）の storage.count_by を返す。
+    WARM_AGGREGATES にある条件だけ AGGREGATE_CACHE_TTL 秒キャッシュする
+    （?minutes= など任意の値をキーにするとキャッシュが際限なく増えるので、それ以外は毎回計算）。
+    """
+    def compute():
+        since_iso = None
+        if minutes is not None:
+            since_iso = (datetime.utcnow() - timedelta(minutes=minutes)).isoformat()
+        return storage.count_by(columns, since_iso=since_iso, with_location=with_location)
+
+    key = (tuple(columns), minutes, with_location)
+    if key not in WARM_AGGREGATE_KEYS:
+        return compute()
+    return aggregate_cache.get_or_compute(key, compute)
+
+
+# 起動時に温めておく集計（各エンドポイントのデフォルト条件）
+WARM_AGGREGATES = [
+    (["region_code"], 30, False),             # summary / map / ping_stats
+    (["region_code", "status"], 30, False),   # summary_status
+    (["lat", "lng"], 30, True),               # ping_stats の grid_stats
+    (["lat", "lng", "status"], 30, True),     # grid_status
+    (["region_code"], None, False),           # map_total / ping_stats
+    (["city_name"], None, False),             # ping_stats
+]
+WARM_AGGREGATE_KEYS = {
+    (tuple(columns), minutes, with_location)
+    for columns, minutes, with_location in WARM_AGGREGATES
+}
+
 
+# --- ユニーク端末数（HyperLogLog） --------------------------------
+
+# /api/pings/unique_devices の ?minutes= の上限（24時間。cleanup_old_pings のデフォルトと同じ）
+UNIQUE_DEVICES_MAX_MINUTES = 24 * 60
+
+
+def load_unique_devices(cutoff: datetime, region_codes=None, area_codes=None):
+    """
+    cutoff 以降のスケッチを merge して
+      (全体のスケッチ, {region_code: スケッチ})
+    を返す。region_codes / area_codes を渡すとその範囲の和集合だけを数える。
+    """
+    by_region = {}
+    # スケッチは merge できるので、シャードをまたいでも和集合がそのまま取れる。
+    # 各行は region ごとに1回だけ merge し、全体は region のスケッチ（数個）から作る
+    rows = storage.load_sketches(sketch_bucket_start(cutoff), region_codes, area_codes)
+    for region_code, registers in rows:
+        sketch = HyperLogLog.from_bytes(registers)
+        if region_code in by_region:
+            by_region[region_code].merge(sketch)
+        else:
+            by_region[region_code] = sketch
+
+    total = HyperLogLog()
+    for sketch in by_region.values():
+        total.merge(sketch)
+    return total, by_region
 
-init_db()
 
 # --- ヘルスチェック ---------------------------------------------
 
 
-@app.route("/health")
+@bp.route("/health")
 def health():
     return jsonify({"status": "ok", "time": datetime.utcnow().isoformat() + "Z"})
 
@@ -137,20 +206,10 @@ def compute_area_code(lat, lng, region_code: str) -> str:
     lng_round = round(lng * 10) / 10.0
     return f"{lat_round:.1f},{lng_round:.1f}"
 
-REGION_CENTER = {
-    "hokkaido_tohoku": {"lat": 39.7, "lng": 141.0, "label": "北海道・東北"},
-    "kanto":           {"lat": 35.7, "lng": 139.7, "label": "関東"},
-    "chubu":           {"lat": 36.2, "lng": 137.9, "label": "中部"},
-    "kansai":          {"lat": 34.7, "lng": 135.5, "label": "関西"},
-    "chugoku_shikoku": {"lat": 34.3, "lng": 133.0, "label": "中国・四国"},
-    "kyushu_okinawa":  {"lat": 32.0, "lng": 130.7, "label": "九州・沖縄"},
-    # World はパリ近辺とか、どこか確実に陸の場所にしておく
-    "world_other":     {"lat": 48.85, "lng": 2.35, "label": "World"},
-}
 
 # --- Ping 登録 API ----------------------------------------------
 
-@app.route("/api/pings", methods=["POST"])
+@bp.route("/api/pings", methods=["POST"])
 def create_ping():
     data = request.get_json() or {}
 
@@ -205,67 +264,23 @@ def create_ping():
             message = msg
     # 無料ユーザーは message = None のまま
 
-    now_iso = datetime.utcnow().isoformat()
-
-    conn = get_db()
-    cur = conn.cursor()
-
-    # ★ device_id ごとに1レコードだけ持つ（UPDATE or INSERT）
-    cur.execute(
-        "SELECT id FROM pings WHERE device_id = ? LIMIT 1",
-        (device_id,),
+    storage.upsert_ping(
+        {
+            "device_id": device_id,
+            "status": status,
+            "region_code": region_code,
+            "city_name": city_name,
+            "area_code": area_code,
+            "lat": lat_val,
+            "lng": lng_val,
+            "message": message,
+        },
+        datetime.utcnow(),
     )
-    row = cur.fetchone()
-
-    if row:
-        ping_id = row["id"]
-        cur.execute(
-            """
-            UPDATE pings
-            SET status = ?, region_code = ?, city_name = ?, area_code = ?,
-                lat = ?, lng = ?, message = ?, created_at = ?
-            WHERE id = ?
-            """,
-            (
-                status,
-                region_code,
-                city_name,
-                area_code,
-                lat_val,
-                lng_val,
-                message,
-                now_iso,
-                ping_id,
-            ),
-        )
-    else:
-        cur.execute(
-            """
-            INSERT INTO pings (
-                device_id, status, region_code, city_name,
-                area_code, lat, lng, message, created_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                device_id,
-                status,
-                region_code,
-                city_name,
-                area_code,
-                lat_val,
-                lng_val,
-                message,
-                now_iso,
-            ),
-        )
-
-    conn.commit()
-    conn.close()
 
     return jsonify({"ok": True, "is_premium": premium}), 201
 
-@app.route("/api/admin/ping_stats")
+@bp.route("/api/admin/ping_stats")
 def admin_ping_stats():
     """
     管理用の統計:
@@ -278,56 +293,17 @@ def admin_ping_stats():
     cutoff = datetime.utcnow() - timedelta(minutes=30)
     cutoff_iso = cutoff.isoformat()
 
-    conn = get_db()
-    cur = conn.cursor()
-
     # A. エリアごとの人数（直近30分）
-    cur.execute(
-        """
-        SELECT region_code, COUNT(*)
-        FROM pings
-        WHERE created_at >= ?
-        GROUP BY region_code
-        """,
-        (cutoff_iso,),
-    )
-    region_recent_rows = cur.fetchall()
+    region_recent_rows = window_counts(["region_code"], minutes=30)
 
     # B. エリアごとの累計人数（全期間）
-    cur.execute(
-        """
-        SELECT region_code, COUNT(*)
-        FROM pings
-        GROUP BY region_code
-        """
-    )
-    region_total_rows = cur.fetchall()
+    region_total_rows = window_counts(["region_code"])
 
     # C. 市ごとの人数（全期間）
-    cur.execute(
-        """
-        SELECT city_name, COUNT(*)
-        FROM pings
-        GROUP BY city_name
-        """
-    )
-    city_rows = cur.fetchall()
+    city_rows = window_counts(["city_name"])
 
     # D. 直近30分の「生の lat / lng ごと」に一旦集計（NULL は除外）
-    cur.execute(
-        """
-        SELECT lat, lng, COUNT(*)
-        FROM pings
-        WHERE created_at >= ?
-          AND lat IS NOT NULL
-          AND lng IS NOT NULL
-        GROUP BY lat, lng
-        """,
-        (cutoff_iso,),
-    )
-    raw_grid_rows = cur.fetchall()
-
-    conn.close()
+    raw_grid_rows = window_counts(["lat", "lng"], minutes=30, with_location=True)
 
     # ★ 世界共通の「粗いグリッド」（例: 0.2度 ≒ 20〜22km）に丸め直す
     CELL_DEG = 0.2  # ここを 0.25 とかに変えればさらに粗くできる
@@ -361,32 +337,14 @@ def admin_ping_stats():
         }
     )
 
-@app.route("/api/pings/grid_status")
+@bp.route("/api/pings/grid_status")
 def pings_grid_status():
     """
     直近30分の「グリッドごとのステータス内訳」を返す。
     フロントのマップ用（ピンをタップしたときに 👀/🌀/🌙/💻 を出す）。
     """
-    cutoff = datetime.utcnow() - timedelta(minutes=30)
-    cutoff_iso = cutoff.isoformat()
-
-    conn = get_db()
-    cur = conn.cursor()
-
     # lat/lng, status ごとに集計
-    cur.execute(
-        """
-        SELECT lat, lng, status, COUNT(*)
-        FROM pings
-        WHERE created_at >= ?
-          AND lat IS NOT NULL
-          AND lng IS NOT NULL
-        GROUP BY lat, lng, status
-        """,
-        (cutoff_iso,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = window_counts(["lat", "lng", "status"], minutes=30, with_location=True)
 
     # {(lat,lng): {"awake": x, "free": y, ...}} にまとめる
     grid_map = {}
@@ -409,7 +367,7 @@ def pings_grid_status():
 
     return jsonify(result)
 
-@app.route("/api/admin/cleanup_old_pings")
+@bp.route("/api/admin/cleanup_old_pings")
 def cleanup_old_pings():
     """
     古い Ping をまとめて削除する簡易API。
@@ -433,30 +391,132 @@ def cleanup_old_pings():
     cutoff = datetime.utcnow() - timedelta(days=days)
     cutoff_iso = cutoff.isoformat()
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        DELETE FROM pings
-        WHERE created_at < ?
-        """,
-        (cutoff_iso,),
+    # スケッチも同じ期間で捨てる
+    deleted_rows, deleted_sketches = storage.delete_before(
+        cutoff_iso, sketch_bucket_start(cutoff)
     )
-    deleted_rows = cur.rowcount
-    conn.commit()
-    conn.close()
 
     return jsonify(
         {
             "ok": True,
             "deleted": deleted_rows,
+            "deleted_sketches": deleted_sketches,
             "cutoff_iso": cutoff_iso,
             "days": days,
         }
     )
 
 
-@app.route("/api/admin/set_premium_device", methods=["POST"])
+# --- エクスポート（分析用） ----------------------------------------
+
+# id はシャードごとの連番なので、シャード時は (shard, id) で1行を特定する（非シャード時は空）
+EXPORT_COLUMNS = PING_COLUMNS + ["shard"]
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    # 1行 = 1チャンク分の列ごとの配列（{"rows": n, "columns": {"id": [...], ...}}）
+    "columnar": "application/x-ndjson",
+}
+
+
+def format_export(rows, fmt: str, chunk_size: int = 1000):
+    """行のイテレータを fmt の文字列チャンクに変換するジェネレータ"""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(EXPORT_COLUMNS)
+        n = 0
+        for row in rows:
+            writer.writerow([row[c] for c in EXPORT_COLUMNS])
+            n += 1
+            if n % chunk_size == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    elif fmt == "columnar":
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield _columnar_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield _columnar_chunk(chunk)
+    else:
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def _columnar_chunk(rows) -> str:
+    columns = {c: [row[c] for row in rows] for c in EXPORT_COLUMNS}
+    return json.dumps({"rows": len(rows), "columns": columns}, ensure_ascii=False) + "\n"
+
+
+def _parse_iso(value):
+    """
+    空なら None、変な文字列なら ValueError。
+    created_at は naive な UTC の文字列なので、タイムゾーン付き（+09:00 など）は UTC に直して外す。
+    """
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat()
+
+
+@bp.route("/api/admin/export_pings")
+def export_pings():
+    """
+    分析用に pings を丸ごとストリーミングで書き出す（管理用）。
+    /api/admin/export_pings?token=...&format=ndjson|csv|columnar
+        &since=2024-01-01T00:00:00&until=...&region_code=kanto&status=awake
+    region_code / status は複数指定可。created_at, id の昇順で出す。
+    シャード時は id がシャードごとの連番なので、(shard, id) で行を特定する。
+    書き出し中に上書きされた端末は、新しい created_at のところでもう一度出ることがある
+    （分析側では device_id ごとに created_at が最新の行を取る）。
+    """
+    token = request.args.get("token")
+    if token != ADMIN_SECRET:
+        return jsonify({"error": "unauthorized"}), 401
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "invalid format"}), 400
+
+    try:
+        since_iso = _parse_iso(request.args.get("since"))
+        until_iso = _parse_iso(request.args.get("until"))
+    except ValueError:
+        return jsonify({"error": "invalid since/until"}), 400
+
+    statuses = request.args.getlist("status")
+    if any(s not in ALLOWED_STATUS for s in statuses):
+        return jsonify({"error": "invalid status"}), 400
+
+    page_size_str = request.args.get("page_size", "1000")
+    try:
+        page_size = min(max(int(page_size_str), 1), 10000)
+    except ValueError:
+        page_size = 1000
+
+    rows = storage.iter_pings(
+        since_iso,
+        until_iso,
+        request.args.getlist("region_code"),
+        statuses,
+        page_size,
+    )
+    ext = "csv" if fmt == "csv" else "ndjson"
+    return Response(
+        format_export(rows, fmt, chunk_size=page_size),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=pings.{ext}"},
+    )
+
+
+@bp.route("/api/admin/set_premium_device", methods=["POST"])
 def set_premium_device():
     """
     管理画面から device_id をプレミアムON/OFFする用のAPI。
@@ -477,20 +537,7 @@ def set_premium_device():
     # boolに正規化（true/false, 1/0 どっちでも来てOK）
     is_premium_flag = bool(is_premium_flag)
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # 既にあれば UPDATE、なければ INSERT （UPSERT）
-    cur.execute(
-        """
-        INSERT INTO premium_devices (device_id, is_premium)
-        VALUES (?, ?)
-        ON CONFLICT(device_id) DO UPDATE SET is_premium = excluded.is_premium
-        """,
-        (device_id, 1 if is_premium_flag else 0),
-    )
-    conn.commit()
-    conn.close()
+    storage.set_premium(device_id, is_premium_flag)
 
     return jsonify(
         {
@@ -501,7 +548,7 @@ def set_premium_device():
     )
 
 
-@app.route("/api/check_premium", methods=["GET"])
+@bp.route("/api/check_premium", methods=["GET"])
 def check_premium():
     """
     フロントから device_id を渡してもらい、
@@ -519,51 +566,62 @@ def check_premium():
 # --- 直近30分のサマリー API --------------------------------------
 
 
-@app.route("/api/pings/summary", methods=["GET"])
+@bp.route("/api/pings/summary", methods=["GET"])
 def ping_summary():
-    now = datetime.utcnow()
-    cutoff = now - timedelta(minutes=30)
-    cutoff_iso = cutoff.isoformat()
-
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT region_code, COUNT(*) AS count
-        FROM pings
-        WHERE created_at >= ?
-        GROUP BY region_code
-        """,
-        (cutoff_iso,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = window_counts(["region_code"], minutes=30)
 
     result = [
-        {"region_code": row["region_code"], "count": row["count"]}
-        for row in rows
+        {"region_code": region_code, "count": count}
+        for (region_code, count) in rows
     ]
     return jsonify(result)
 
-@app.route("/api/pings/map")
-def pings_map():
-    """地図に表示するポイント（エリアごと）"""
-    cutoff = datetime.utcnow() - timedelta(minutes=30)
-    cutoff_iso = cutoff.isoformat()
+@bp.route("/api/pings/unique_devices")
+def pings_unique_devices():
+    """
+    直近 N 分のユニーク端末数（HyperLogLog による概算）。
+    クエリ:
+      ?minutes=30
+      &region_code=kanto&region_code=kansai   （複数指定で和集合）
+      &area_code=35.7,139.7                   （複数指定で和集合）
+    minutes は UNIQUE_DEVICES_MAX_MINUTES で頭打ち。
+    窓の始まりは SKETCH_BUCKET_MINUTES 単位で切り下げになるので、
+    最大でそのぶん古い ping も含まれる。
+    """
+    minutes_str = request.args.get("minutes", "30")
+    try:
+        minutes = int(minutes_str)
+        if minutes <= 0:
+            minutes = 30
+    except ValueError:
+        minutes = 30
+    # 長すぎる窓はスケッチを大量に merge することになるので上限で切る
+    minutes = min(minutes, UNIQUE_DEVICES_MAX_MINUTES)
+
+    region_codes = request.args.getlist("region_code")
+    area_codes = request.args.getlist("area_code")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT region_code, COUNT(*)
-        FROM pings
-        WHERE created_at >= ?
-        GROUP BY region_code
-        """,
-        (cutoff_iso,),
+    cutoff = datetime.utcnow() - timedelta(minutes=minutes)
+    total, by_region = load_unique_devices(cutoff, region_codes, area_codes)
+
+    return jsonify(
+        {
+            "minutes": minutes,
+            "cutoff_iso": sketch_bucket_start(cutoff),
+            "unique_devices": total.count(),
+            "by_region": [
+                {"region_code": r, "unique_devices": sketch.count()}
+                for r, sketch in sorted(by_region.items())
+            ],
+            # 標準誤差の目安（p=12 で約1.6%）
+            "std_error": round(1.04 / (2 ** (DEFAULT_PRECISION / 2)), 4),
+        }
     )
-    rows = cur.fetchall()
-    conn.close()
+
+@bp.route("/api/pings/map")
+def pings_map():
+    """地図に表示するポイント（エリアごと）"""
+    rows = window_counts(["region_code"], minutes=30)
 
     result = []
     for region_code, count in rows:
@@ -581,20 +639,10 @@ def pings_map():
 
     return jsonify(result)
 
-@app.route("/api/pings/map_total")
+@bp.route("/api/pings/map_total")
 def pings_map_total():
     """エリアごとの累計ピコン数（時間条件なし）"""
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT region_code, COUNT(*)
-        FROM pings
-        GROUP BY region_code
-        """
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = window_counts(["region_code"])
 
     result = []
     for region_code, count in rows:
@@ -612,7 +660,7 @@ def pings_map_total():
 
     return jsonify(result)
 
-@app.route("/api/pings/map_points")
+@bp.route("/api/pings/map_points")
 def pings_map_points():
     """
     マップ用: 1ピン = 1ユーザーの Ping 一覧を返す。
@@ -621,22 +669,7 @@ def pings_map_points():
     cutoff = datetime.utcnow() - timedelta(hours=24)
     cutoff_iso = cutoff.isoformat()
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, status, lat, lng, message, created_at
-        FROM pings
-        WHERE created_at >= ?
-          AND lat IS NOT NULL
-          AND lng IS NOT NULL
-        ORDER BY created_at DESC
-        LIMIT 500
-        """,
-        (cutoff_iso,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = storage.map_points(cutoff_iso, limit=500)
 
     result = []
     for row in rows:
@@ -648,13 +681,14 @@ def pings_map_points():
                 "lng": row["lng"],
                 "hasMessage": bool(row["message"]),
                 "createdAt": row["created_at"],
+                "shard": row["shard"],
             }
         )
 
     return jsonify(result)
 
 
-@app.route("/api/messages/by_grid", methods=["GET"])
+@bp.route("/api/messages/by_grid", methods=["GET"])
 def messages_by_grid():
     """
     プレミアムユーザー向け:
@@ -697,22 +731,7 @@ def messages_by_grid():
     cutoff = datetime.utcnow() - timedelta(minutes=30)
     cutoff_iso = cutoff.isoformat()
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT device_id, status, message, created_at
-        FROM pings
-        WHERE created_at >= ?
-          AND area_code = ?
-          AND message IS NOT NULL
-        ORDER BY created_at DESC
-        LIMIT 50
-        """,
-        (cutoff_iso, area_code),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = storage.messages_by_area(area_code, cutoff_iso, limit=50)
 
     messages = []
     for row in rows:
@@ -735,7 +754,7 @@ def messages_by_grid():
     )
 
 
-@app.route("/api/pings/summary_status")
+@bp.route("/api/pings/summary_status")
 def ping_summary_status():
     minutes_str = request.args.get("minutes", "30")
     try:
@@ -743,22 +762,7 @@ def ping_summary_status():
     except ValueError:
         minutes = 30
 
-    cutoff = datetime.utcnow() - timedelta(minutes=minutes)
-    cutoff_iso = cutoff.isoformat()
-
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT region_code, status, COUNT(*) AS count
-        FROM pings
-        WHERE created_at >= ?
-        GROUP BY region_code, status
-        """,
-        (cutoff_iso,),
-    )
-    rows = cur.fetchall()
-    conn.close()
+    rows = window_counts(["region_code", "status"], minutes=minutes)
 
     result = [
       {"region_code": r, "status": s, "count": c}
@@ -766,11 +770,176 @@ def ping_summary_status():
     ]
     return jsonify(result)
 
-@app.route("/admin/dashboard")
+@bp.route("/admin/dashboard")
 @requires_auth
 def admin_dashboard():
     return render_template("admin_dashboard.html")
 
+
+# --- プロファイル --------------------------------------------------
+
+
+@bp.before_app_request
+def start_request_profile():
+    """署名付き or 抜き取り対象のリクエストなら cProfile と SQL の記録を始める"""
+    # 署名付きは抜き取りとは別枠で残すので、抜き取りにも当たっても sampled=False
+    signed = is_profile_requested(request, ADMIN_SECRET)
+    sampled = not signed and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not sampled and not signed:
+        return
+    profile = RequestProfile(storage._get_current_object(), sampled)
+    # 同じプロセスで別のプロファイルが動いていたら、このリクエストは取らない
+    if profile.start():
+        g.request_profile = profile
+
+
+@bp.after_app_request
+def finish_request_profile(response):
+    """ボディを出し切って閉じるときに止める（ストリーミングでも最後まで測る）"""
+    profile = g.pop("request_profile", None)
+    if profile is not None:
+        profile.set_response(request, response.status_code)
+        response.headers["X-Profile-Id"] = profile.id
+        response.call_on_close(
+            lambda: profile.finish(
+                PROFILE_DIR, PROFILE_KEEP, PROFILE_KEEP_SIGNED, PROFILE_WINDOW_HOURS
+            )
+        )
+    return response
+
+
+@bp.teardown_app_request
+def abort_request_profile(exc):
+    """after_request まで行かなかった（例外で抜けた）ときは止めて捨てる"""
+    profile = g.pop("request_profile", None)
+    if profile is not None:
+        profile.abort()
+
+
+@bp.route("/api/admin/profiles")
+@requires_auth
+def admin_profiles():
+    """保存済みプロファイルを遅い順に（ダッシュボード用）"""
+    return jsonify(
+        {
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "keep": PROFILE_KEEP,
+            "keep_signed": PROFILE_KEEP_SIGNED,
+            "window_hours": PROFILE_WINDOW_HOURS,
+            "profiles": load_report(PROFILE_DIR),
+        }
+    )
+
+
+@bp.route("/api/admin/profiles/<profile_id>")
+@requires_auth
+def admin_profile_detail(profile_id):
+    """1件分の詳細（上位の関数・SQL と EXPLAIN QUERY PLAN）"""
+    meta = load_profile(PROFILE_DIR, profile_id)
+    if meta is None:
+        return jsonify({"error": "not found"}), 404
+    explain_all(storage, meta.get("sql", []))
+    return jsonify(meta)
+
+
+@bp.route("/api/admin/profiles/<profile_id>/dump")
+@requires_auth
+def admin_profile_dump(profile_id):
+    """cProfile の .prof（snakeviz / flameprof などで開く）"""
+    if load_profile(PROFILE_DIR, profile_id) is None:
+        return jsonify({"error": "not found"}), 404
+    return send_file(
+        os.path.join(PROFILE_DIR, profile_id + ".prof"),
+        mimetype="application/octet-stream",
+        as_attachment=True,
+        download_name=profile_id + ".prof",
+    )
+
+
+@bp.cli.command("profile-sign")
+@click.argument("path")
+@click.option("--ttl", type=click.IntRange(1), default=600, show_default=True,
+              help="署名の有効期間（秒）")
+def profile_sign_command(path, ttl):
+    """
+    PATH をプロファイルするためのヘッダを出す（そのまま curl -H に渡す）:
+        flask --app app profile-sign /api/pings/summary --ttl 300
+    """
+    expires = int(time.time()) + ttl
+    click.echo(f"X-Profile-Expires: {expires}")
+    click.echo(f"X-Profile-Signature: {profile_signature(ADMIN_SECRET, path, expires)}")
+
+
+@bp.cli.command("export-pings")
+@click.option("--format", "fmt", type=click.Choice(sorted(EXPORT_FORMATS)), default="ndjson")
+@click.option("--since", default=None, help="ISO日時（この時刻以降）")
+@click.option("--until", default=None, help="ISO日時（この時刻より前）")
+@click.option("--region-code", multiple=True)
+@click.option("--status", multiple=True, type=click.Choice(sorted(ALLOWED_STATUS)))
+@click.option("--page-size", type=click.IntRange(1, 10000), default=1000, show_default=True)
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-")
+def export_pings_command(fmt, since, until, region_code, status, page_size, output):
+    """pings を標準出力（or --output）に書き出す: flask --app app export-pings --format csv"""
+    try:
+        since_iso = _parse_iso(since)
+    except ValueError:
+        raise click.BadParameter("ISO日時で指定してください", param_hint="--since")
+    try:
+        until_iso = _parse_iso(until)
+    except ValueError:
+        raise click.BadParameter("ISO日時で指定してください", param_hint="--until")
+
+    rows = storage.iter_pings(
+        since_iso,
+        until_iso,
+        list(region_code),
+        list(status),
+        page_size,
+    )
+    for chunk in format_export(rows, fmt, chunk_size=page_size):
+        output.write(chunk)
+
+
+def create_app(storage_engine=None, warm=True):
+    """
+    アプリを作る。スキーマ確認（CREATE TABLE IF NOT EXISTS）とキャッシュのウォームアップもここ。
+    gunicorn は preload_app = True（gunicorn.conf.py）で master が1回だけこれを呼び、
+    温まったキャッシュごと各ワーカーに fork する。
+    """
+    app = Flask(__name__)
+
+    store = create_storage(
+        storage_engine or STORAGE_ENGINE,
+        db_path=DB_PATH,
+        shard_mode=SHARD_MODE,
+        shard_count=SHARD_COUNT,
+        shard_regions=list(REGION_CENTER),
+    )
+    app.extensions["hereping.storage"] = store
+    app.extensions["hereping.premium_cache"] = PremiumCache(store)
+    app.extensions["hereping.aggregate_cache"] = TTLCache(AGGREGATE_CACHE_TTL)
+    app.register_blueprint(bp)
+
+    store.init()
+
+    if warm:
+        with app.app_context():
+            warm_caches()
+
+    return app
+
+
+def warm_caches():
+    """プレミアム集合と直近の集計を先に作っておく（fork 前に呼べばワーカー間で共有される）"""
+    premium_cache.refresh()
+    for columns, minutes, with_location in WARM_AGGREGATES:
+        window_counts(columns, minutes, with_location)
+
+
+# gunicorn -c gunicorn.conf.py app:app / flask --app app 用
+# WARM_ON_STARTUP=0 でウォームアップなし（起動ベンチの比較用）
+app = create_app(warm=os.environ.get("WARM_ON_STARTUP", "1") != "0")
+
 if __name__ == "__main__":
     # ローカルテスト用
     app.run(debug=True)
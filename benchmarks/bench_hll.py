@@ -0,0 +1,82 @@
+# benchmarks/bench_hll.py
+"""
+HyperLogLog の概算値と「正確なユニーク数（set）」を比べるベンチ。
+
+    python benchmarks/bench_hll.py
+    python benchmarks/bench_hll.py --precision 14 --buckets 6
+
+- 端末IDを時間バケットごとにばらまき（同じ端末が複数バケットに出てくる）、
+  バケットごとのスケッチを merge した値と set の件数を比較する
+- 誤差と、add / merge / count の所要時間、メモリ（bytes）を出す
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hll import HyperLogLog  # noqa: E402
+
+
+def run(cardinality: int, precision: int, buckets: int, seed: int):
+    rnd = random.Random(seed)
+    devices = [f"hp-{rnd.getrandbits(64):016x}" for _ in range(cardinality)]
+
+    exact_sets = [set() for _ in range(buckets)]
+    sketches = [HyperLogLog(p=precision) for _ in range(buckets)]
+
+    t0 = time.perf_counter()
+    for device_id in devices:
+        # 1端末あたり 1〜3 バケットに ping が出る想定
+        for b in rnd.sample(range(buckets), rnd.randint(1, min(3, buckets))):
+            exact_sets[b].add(device_id)
+            sketches[b].add(device_id)
+    t_add = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    merged = HyperLogLog(p=precision)
+    for s in sketches:
+        merged.merge(s)
+    t_merge = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    estimate = merged.count()
+    t_count = time.perf_counter() - t0
+
+    exact = len(set().union(*exact_sets))
+    error = (estimate - exact) / exact if exact else 0.0
+    return {
+        "exact": exact,
+        "estimate": estimate,
+        "error": error,
+        "add_s": t_add,
+        "merge_s": t_merge,
+        "count_s": t_count,
+        "sketch_bytes": len(merged.to_bytes()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", type=int, default=12)
+    parser.add_argument("--buckets", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    expected = 1.04 / (2 ** (args.precision / 2))
+    print(f"precision={args.precision} buckets={args.buckets} "
+          f"expected std error={expected:.2%}")
+    print(f"{'exact':>9} {'estimate':>9} {'error':>8} {'add[s]':>8} "
+          f"{'merge[ms]':>9} {'count[ms]':>9} {'bytes':>6}")
+
+    for n in (10, 100, 1_000, 10_000, 100_000):
+        r = run(n, args.precision, args.buckets, args.seed)
+        print(f"{r['exact']:>9} {r['estimate']:>9} {r['error']:>8.2%} "
+              f"{r['add_s']:>8.3f} {r['merge_s'] * 1000:>9.2f} "
+              f"{r['count_s'] * 1000:>9.2f} {r['sketch_bytes']:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# benchmarks/bench_startup.py
+"""
+起動時間とワーカー起動直後の「最初のリクエスト」のレイテンシを比べるベンチ。
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --pings 100000
+
+一時ディレクトリに pings を入れた DB を作り、別プロセスで
+  - WARM_ON_STARTUP=0（create_app でウォームアップしない）
+  - WARM_ON_STARTUP=1（プレミアム集合と直近の集計を温める）
+の2通りで app を import → 各エンドポイントに1回ずつリクエストして時間を測る。
+preload 時はこの import が master で1回だけ走り、ワーカーは温まった状態で fork される。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+ENDPOINTS = [
+    "/api/pings/summary",
+    "/api/pings/map",
+    "/api/pings/map_total",
+    "/api/pings/summary_status",
+    "/api/pings/grid_status",
+    "/api/admin/ping_stats",
+    "/api/check_premium?device_id=hp-1",
+]
+
+
+def seed(db_path: str, n: int):
+    from bench_storage import make_pings
+    from storage import SQLiteStorage
+
+    store = SQLiteStorage(db_path)
+    store.init()
+    now = datetime.utcnow()
+    for ping in make_pings(n, n, seed=42):
+        store.upsert_ping(ping, now)
+    store.set_premium("hp-1", True)
+
+
+def child():
+    t0 = time.perf_counter()
+    import app as hereping
+    startup = time.perf_counter() - t0
+
+    client = hereping.app.test_client()
+    first = {}
+    for url in ENDPOINTS:
+        t = time.perf_counter()
+        client.get(url)
+        first[url] = time.perf_counter() - t
+    print(json.dumps({"startup": startup, "first": first}))
+
+
+def run_child(db_path: str, warm: bool):
+    env = dict(os.environ, DB_PATH=db_path, WARM_ON_STARTUP="1" if warm else "0")
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        env=env, cwd=ROOT, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pings", type=int, default=20000)
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "pings_v2.db")
+        seed(db_path, args.pings)
+
+        cold = run_child(db_path, warm=False)
+        warm = run_child(db_path, warm=True)
+
+    print(f"pings={args.pings}")
+    print(f"{'':<36} {'no warm':>10} {'warm':>10}")
+    print(f"{'import + create_app [ms]':<36} "
+          f"{cold['startup'] * 1000:>10.1f} {warm['startup'] * 1000:>10.1f}")
+    for url in ENDPOINTS:
+        print(f"{url:<36} {cold['first'][url] * 1000:>10.2f} {warm['first'][url] * 1000:>10.2f}")
+    total_cold = sum(cold["first"].values()) * 1000
+    total_warm = sum(warm["first"].values()) * 1000
+    print(f"{'first requests total [ms]':<36} {total_cold:>10.2f} {total_warm:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# benchmarks/bench_storage.py
+"""
+ストレージエンジンごとのスループット比較（sqlite / sqlite+シャード / memory）。
+
+    python benchmarks/bench_storage.py
+    python benchmarks/bench_storage.py --pings 50000 --devices 5000
+
+- upsert_ping を N 回（同じ端末の上書きも混ぜる）
+- 直近30分の count_by / map_points / messages_by_area / is_premium を M 回
+それぞれの ops/s を出す。sqlite は一時ディレクトリに作って最後に消す。
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from storage import MemoryStorage, SQLiteStorage  # noqa: E402
+
+REGIONS = ["hokkaido_tohoku", "kanto", "chubu", "kansai",
+           "chugoku_shikoku", "kyushu_okinawa", "world_other"]
+STATUSES = ["awake", "free", "cantSleep", "working"]
+
+
+def make_pings(n: int, devices: int, seed: int, move_rate: float = 0.02):
+    """
+    端末ごとに「いつものエリア」を決めておき、move_rate の割合だけ別エリアから送る
+    （実際の端末はほとんど同じ region から ping するので、毎回ランダムにはしない）
+    """
+    rnd = random.Random(seed)
+    pings = []
+    for _ in range(n):
+        device = rnd.randrange(devices)
+        region = REGIONS[device % len(REGIONS)]
+        if rnd.random() < move_rate:
+            region = rnd.choice(REGIONS)
+        lat = round(rnd.uniform(31.0, 43.0), 2)
+        lng = round(rnd.uniform(129.0, 145.0), 2)
+        pings.append(
+            {
+                "device_id": f"hp-{device}",
+                "status": rnd.choice(STATUSES),
+                "region_code": region,
+                "city_name": f"city-{rnd.randrange(50)}",
+                "area_code": f"{round(lat, 1):.1f},{round(lng, 1):.1f}",
+                "lat": lat,
+                "lng": lng,
+                "message": "hello" if rnd.random() < 0.2 else None,
+            }
+        )
+    return pings
+
+
+def timed(label: str, n: int, fn):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    elapsed = time.perf_counter() - t0
+    print(f"  {label:<22} {n / elapsed:>10.0f} ops/s")
+
+
+def bench(name: str, storage, pings, reads: int):
+    print(name)
+    storage.init()
+    now = datetime.utcnow()
+    it = iter(pings)
+    timed("upsert_ping", len(pings), lambda: storage.upsert_ping(next(it), now))
+
+    since = (now - timedelta(minutes=30)).isoformat()
+    area = pings[0]["area_code"]
+    timed("count_by(region)", reads, lambda: storage.count_by(["region_code"], since))
+    timed("count_by(lat,lng)", reads,
+          lambda: storage.count_by(["lat", "lng"], since, with_location=True))
+    timed("map_points(500)", reads, lambda: storage.map_points(since, 500))
+    timed("messages_by_area(50)", reads, lambda: storage.messages_by_area(area, since, 50))
+    timed("is_premium", reads * 10, lambda: storage.is_premium("hp-1"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pings", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    pings = make_pings(args.pings, args.devices, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench("sqlite", SQLiteStorage(os.path.join(tmp, "pings_v2.db")), pings, args.reads)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench(
+            "sqlite (SHARD_MODE=region)",
+            SQLiteStorage(os.path.join(tmp, "pings_v2.db"), "region", shard_regions=REGIONS),
+            pings,
+            args.reads,
+        )
+
+    bench("memory", MemoryStorage(), pings, args.reads)
+
+
+if __name__ == "__main__":
+    main()
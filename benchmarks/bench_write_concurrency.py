@@ -0,0 +1,80 @@
+# benchmarks/bench_write_concurrency.py
+"""
+複数プロセスから同時に upsert_ping したときの書き込みスループット比較
+（SHARD_MODE なし / region / device）。gunicorn のワーカーが並んで書き込む状況の再現。
+
+    python benchmarks/bench_write_concurrency.py
+    python benchmarks/bench_write_concurrency.py --workers 1 2 4 8 --pings 2000
+
+各ワーカーは同じ端末集合（--devices）に ping を投げるので、
+region モードでは端末のシャード移動も混ざる。結果は全ワーカー合計の ops/s。
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bench_storage import REGIONS, make_pings  # noqa: E402
+from storage import SQLiteStorage  # noqa: E402
+
+MODES = ["", "region", "device"]
+
+
+def make_storage(db_path: str, mode: str):
+    return SQLiteStorage(db_path, mode, shard_count=len(REGIONS), shard_regions=REGIONS)
+
+
+def worker(db_path: str, mode: str, pings, start, done):
+    storage = make_storage(db_path, mode)
+    start.wait()
+    now = datetime.utcnow()
+    for ping in pings:
+        storage.upsert_ping(ping, now)
+    done.put(len(pings))
+
+
+def run(mode: str, workers: int, pings_per_worker: int, devices: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "pings_v2.db")
+        make_storage(db_path, mode).init()
+
+        start = multiprocessing.Barrier(workers + 1)
+        done = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=worker,
+                args=(db_path, mode, make_pings(pings_per_worker, devices, seed=i), start, done),
+            )
+            for i in range(workers)
+        ]
+        for p in procs:
+            p.start()
+        start.wait()
+        t0 = time.perf_counter()
+        total = sum(done.get() for _ in procs)
+        elapsed = time.perf_counter() - t0
+        for p in procs:
+            p.join()
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--pings", type=int, default=1000, help="ワーカー1つあたり")
+    parser.add_argument("--devices", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8}" + "".join(f"{m or 'single':>12}" for m in MODES) + "  (ops/s)")
+    for n in args.workers:
+        row = [run(m, n, args.pings, args.devices) for m in MODES]
+        print(f"{n:>8}" + "".join(f"{v:>12.0f}" for v in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# cache.py
+"""
+プロセス内の小さなキャッシュ。
+
+gunicorn の preload_app で master が create_app() → ウォームアップしてから fork すると、
+ここに載った値は各ワーカーから copy-on-write で共有される
+（ワーカーが起動直後に DB へ冷えたクエリを一斉に投げなくて済む）。
+ワーカー間で同期はしないので、集計は TTL で、プレミアム集合は storage 側の version で作り直す。
+"""
+import time
+
+
+class TTLCache:
+    """
+    key → (期限, 値) の dict。ttl=0 ならキャッシュせず毎回計算する。
+    max_size 件を超えそうになったら期限切れを捨て、それでも一杯なら古く入れたものから捨てる。
+    """
+
+    def __init__(self, ttl: float, max_size: int = 64):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = {}
+
+    def get_or_compute(self, key, compute):
+        if self.ttl <= 0:
+            return compute()
+        now = time.monotonic()
+        hit = self._data.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+        value = compute()
+        if key not in self._data and len(self._data) >= self.max_size:
+            self._evict(now)
+        self._data[key] = (now + self.ttl, value)
+        return value
+
+    def _evict(self, now: float):
+        for k in [k for k, (expires, _) in self._data.items() if expires <= now]:
+            del self._data[k]
+        while len(self._data) >= self.max_size:
+            del self._data[next(iter(self._data))]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PremiumCache:
+    """
+    プレミアム端末IDの集合を丸ごと持っておく（件数が少ない前提）。
+    判定のたびに storage.premium_version()（ファイルの stat 程度の軽い確認）だけを見て、
+    変わっていたら集合を読み直す。集合に無い＝非プレミアムもそのまま答えられるので、
+    ON/OFF が無いあいだは DB に問い合わせない。どのワーカーでの変更も次の判定から反映される。
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._ids = frozenset()
+        self._version = None
+
+    def refresh(self):
+        # version を先に読む（読み直しの途中で変わっても、次の判定でもう一度読み直す）
+        version = self.storage.premium_version()
+        self._ids = frozenset(self.storage.premium_device_ids())
+        self._version = version
+
+    def is_premium(self, device_id: str) -> bool:
+        if self.storage.premium_version() != self._version:
+            self.refresh()
+        return device_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
@@ -0,0 +1,23 @@
+# gunicorn.conf.py
+# gunicorn -c gunicorn.conf.py app:app
+# （bind / workers はデフォルトどおり $PORT / $WEB_CONCURRENCY を見る）
+import gc
+
+# master で1回だけ app を import する（= create_app: スキーマ確認 + キャッシュのウォームアップ）。
+# ワーカーはそれを fork するので、温まったキャッシュを copy-on-write で共有して起動する。
+preload_app = True
+
+
+def pre_fork(server, worker):
+    """
+    ワーカーを fork する直前（起動時・再起動時・増設時すべて）に master で呼ばれる。
+    キャッシュは TTL 付きなので、ここで作り直してから渡す。
+    """
+    from app import warm_caches
+
+    with server.app.wsgi().app_context():
+        warm_caches()
+
+    # ここまでに作ったオブジェクトを GC の対象外にしておく
+    # （ワーカー側の GC が参照カウントを書き換えて共有ページをコピーしてしまうのを防ぐ）
+    gc.freeze()
@@ -0,0 +1,97 @@
+# hll.py
+"""
+ユニーク端末数をざっくり数えるための HyperLogLog スケッチ。
+
+- 1スケッチ = 2**p バイト（p=12 なら 4KB）で、何台入れてもメモリは一定
+- 同じ p 同士なら merge（レジスタごとの max）で「和集合」の件数が出せる
+  → 時間バケットやエリアをまたいだ集計は merge してから count() するだけ
+
+誤差の目安（標準誤差 ≒ 1.04 / sqrt(2**p)）:
+    p=10 → 約3.3%   p=12 → 約1.6%   p=14 → 約0.8%
+だいたい 95% のケースで ±2σ（p=12 なら ±3.3%）に収まる。
+少数（2.5 * 2**p 以下）のときは linear counting に切り替えるので、
+数十台程度ならほぼ正確な値になる。
+切り替え直後（2.5 * 2**p 〜 5 * 2**p 付近）は素の推定値がやや上振れする
+（p=12・1万台前後で平均 +1〜2%）ので、その帯域は誤差を少し大きめに見ておく。
+実測は benchmarks/bench_hll.py を参照。
+"""
+import hashlib
+import math
+
+DEFAULT_PRECISION = 12
+
+
+def _hash64(value: str) -> int:
+    """プロセスをまたいでも同じ値になる 64bit ハッシュ（hash() はランダム化されるのでNG）"""
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _alpha(m: int) -> float:
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog:
+    def __init__(self, p: int = DEFAULT_PRECISION, registers=None):
+        if not 4 <= p <= 16:
+            raise ValueError("p must be between 4 and 16")
+        self.p = p
+        self.m = 1 << p
+        if registers is None:
+            self.registers = bytearray(self.m)
+        else:
+            if len(registers) != self.m:
+                raise ValueError("register size does not match precision")
+            self.registers = bytearray(registers)
+
+    def add(self, value: str) -> bool:
+        """値を1件追加。レジスタが更新されたら True を返す"""
+        x = _hash64(value)
+        idx = x >> (64 - self.p)
+        rest_bits = 64 - self.p
+        w = x & ((1 << rest_bits) - 1)
+        # 先頭から数えて最初に 1 が出る位置（全部0なら rest_bits + 1）
+        rho = rest_bits - w.bit_length() + 1
+        if rho > self.registers[idx]:
+            self.registers[idx] = rho
+            return True
+        return False
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """other を自分に取り込む（和集合）。自分自身を返す"""
+        if other.p != self.p:
+            raise ValueError("cannot merge sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        m = self.m
+        inv_sum = 0.0
+        zeros = 0
+        for r in self.registers:
+            inv_sum += 2.0 ** -r
+            if r == 0:
+                zeros += 1
+
+        estimate = _alpha(m) * m * m / inv_sum
+        # 少数のときは linear counting のほうが精度が良い
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        p = int(math.log2(len(data)))
+        return cls(p=p, registers=data)
+
+    def __len__(self):
+        return self.count()
@@ -0,0 +1,234 @@
+# profiling.py
+"""
+リクエスト単位のプロファイル（cProfile + 実行した SQL の EXPLAIN QUERY PLAN）。
+
+- 管理者が署名付きで叩いたリクエスト（X-Profile-Expires / X-Profile-Signature ヘッダ。
+  署名は path と有効期限に対してつけるので、期限が過ぎたら使えない。
+  クエリ文字列だとアクセスログに残るので受け付けない）
+- PROFILE_SAMPLE_RATE の確率で抜き取ったリクエスト
+を profile_dir に
+    <id>.prof … cProfile の pstats ダンプ（snakeviz / flameprof / gprof2dot でそのまま開ける）
+    <id>.json … 所要時間・上位の関数・SQL（? のまま + 引数の数。値は残さない）
+として保存する（ディレクトリはワーカー間で共有される）。残すのは
+    抜き取り分 … 直近 window_hours 時間のうち遅い順に keep 件（速いものから消える）
+    署名付き分 … 新しい順に keep_signed 件（抜き取り分とは別枠）
+EXPLAIN QUERY PLAN はリクエスト中には取らず、詳細を開いたときに explain_all で取る。
+"""
+import cProfile
+import glob
+import hashlib
+import hmac
+import json
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+
+# 実行計画を取る SQL（BEGIN / COMMIT などは除く）
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+PROFILE_ID_RE = re.compile(r"^[0-9A-Za-z_]+$")
+
+
+def profile_signature(secret: str, path: str, expires: int) -> str:
+    """"path|expires"（expires は UNIX 秒）に対する署名（ADMIN_SECRET の HMAC-SHA256）"""
+    message = f"{path}|{expires}".encode("utf-8")
+    return hmac.new(secret.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def is_profile_requested(req, secret: str) -> bool:
+    """期限内の署名付きでプロファイルを要求されているか"""
+    sig = req.headers.get("X-Profile-Signature")
+    expires_str = req.headers.get("X-Profile-Expires")
+    if not sig or not expires_str:
+        return False
+    try:
+        expires = int(expires_str)
+    except ValueError:
+        return False
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sig, profile_signature(secret, req.path, expires))
+
+
+# cProfile を有効にできるのは1プロセスに1つだけ（3.12 以降は sys.monitoring ベースで、
+# 2つ目の enable() は ValueError になる）。スレッドワーカーでも同時には1件しか取らない
+_active_lock = threading.Lock()
+
+
+class RequestProfile:
+    """
+    1リクエスト分のプロファイル。start() → （ビュー実行） → set_response() → finish()。
+    finish() はレスポンスのボディを出し切った後（response.call_on_close）に呼ぶので、
+    ストリーミング（export_pings など）も最後まで測れる。
+    """
+
+    def __init__(self, storage, sampled: bool):
+        self.storage = storage
+        self.sampled = sampled
+        self.profiler = cProfile.Profile()
+        self.started = 0.0
+        self.id = "%s_%s" % (datetime.utcnow().strftime("%Y%m%dT%H%M%S"), secrets.token_hex(4))
+        self.request_info = {}
+
+    def start(self) -> bool:
+        """始められたら True。他のプロファイルが動いているときは取らずに False"""
+        if not _active_lock.acquire(blocking=False):
+            return False
+        self.storage.start_trace()
+        try:
+            self.profiler.enable()
+        except ValueError:  # デバッガなど他のプロファイラが動いている
+            self.storage.stop_trace()
+            _active_lock.release()
+            return False
+        self.started = time.perf_counter()
+        return True
+
+    def set_response(self, req, status_code: int):
+        """リクエストの情報を控えておく（finish の時点ではリクエストコンテキストが無いことがある）"""
+        self.request_info = {
+            "method": req.method,
+            "path": req.path,
+            "endpoint": req.endpoint,
+            "status": status_code,
+        }
+
+    def abort(self):
+        """レスポンスまで行かなかったとき（例外など）に止めて捨てる"""
+        self.profiler.disable()
+        self.storage.stop_trace()
+        _active_lock.release()
+
+    def finish(self, profile_dir: str, keep: int, keep_signed: int,
+               window_hours: float) -> str:
+        """止めて保存し、profile id を返す"""
+        try:
+            self.profiler.disable()
+            duration_ms = (time.perf_counter() - self.started) * 1000
+            statements = self.storage.stop_trace()
+        finally:
+            _active_lock.release()
+
+        profile_id = self.id
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profiler.dump_stats(os.path.join(profile_dir, profile_id + ".prof"))
+
+        meta = {
+            "id": profile_id,
+            "created_at": datetime.utcnow().isoformat(),
+            **self.request_info,
+            "duration_ms": round(duration_ms, 2),
+            "sampled": self.sampled,
+            "top_functions": _top_functions(self.profiler),
+            "sql": _group_statements(statements),
+        }
+        with open(os.path.join(profile_dir, profile_id + ".json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        _prune(profile_dir, keep, keep_signed, window_hours)
+        return profile_id
+
+
+def _group_statements(statements):
+    """同じ SQL（? のまま）はまとめて回数をつける。実行計画は詳細を見るときに explain_all で取る"""
+    seen = {}
+    for shard, sql, param_count in statements:
+        if not _EXPLAINABLE.match(sql):
+            continue
+        sql = " ".join(sql.split())
+        key = (shard, sql)
+        if key in seen:
+            seen[key]["count"] += 1
+            continue
+        seen[key] = {"shard": shard, "sql": sql, "params": param_count, "count": 1}
+    return list(seen.values())
+
+
+def explain_all(storage, sql_entries):
+    """profile の "sql" に EXPLAIN QUERY PLAN をつける（リクエストの外で呼ぶ）"""
+    for entry in sql_entries:
+        try:
+            entry["plan"] = storage.explain(entry["shard"], entry["sql"], entry["params"])
+        except Exception as e:  # 実行計画が取れなくても他の行は出す
+            entry["plan"] = [f"(explain failed: {e})"]
+    return sql_entries
+
+
+def _top_functions(profiler, limit: int = 25):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, lineno, func), (cc, nc, tt, ct, _callers) in stats.stats.items():
+        rows.append(
+            {
+                "func": f"{os.path.basename(filename)}:{lineno}({func})",
+                "ncalls": nc,
+                "tottime_ms": round(tt * 1000, 3),
+                "cumtime_ms": round(ct * 1000, 3),
+            }
+        )
+    rows.sort(key=lambda r: r["cumtime_ms"], reverse=True)
+    return rows[:limit]
+
+
+def _prune(profile_dir: str, keep: int, keep_signed: int, window_hours: float):
+    """
+    抜き取り分は window_hours より古いものを捨てたうえで duration_ms の大きい順に keep 件、
+    署名付き分は新しい順に keep_signed 件だけ残す
+    """
+    window_start = (datetime.utcnow() - timedelta(hours=window_hours)).isoformat()
+    sampled = []
+    signed = []
+    for path in glob.glob(os.path.join(profile_dir, "*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue  # 書き込み途中・他のワーカーの prune と競合したものは飛ばす
+        if meta.get("sampled"):
+            sampled.append((meta["created_at"], meta["duration_ms"], path))
+        else:
+            signed.append((meta["created_at"], meta["duration_ms"], path))
+
+    stale = [m for m in sampled if m[0] < window_start]
+    recent = sorted((m for m in sampled if m[0] >= window_start),
+                    key=lambda m: m[1], reverse=True)
+    signed.sort(reverse=True)
+    for _created_at, _duration_ms, path in stale + recent[keep:] + signed[keep_signed:]:
+        base = path[: -len(".json")]
+        for p in (path, base + ".prof"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+
+def load_profile(profile_dir: str, profile_id: str):
+    """id の JSON を返す（無ければ None）"""
+    if not PROFILE_ID_RE.match(profile_id):
+        return None
+    path = os.path.join(profile_dir, profile_id + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_report(profile_dir: str, limit: int = 20):
+    """保存済みのプロファイルを遅い順に limit 件（一覧用に中身は間引く）"""
+    report = []
+    for path in glob.glob(os.path.join(profile_dir, "*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue  # 書き込み途中・prune と競合したものは飛ばす
+        meta["top_functions"] = meta.get("top_functions", [])[:5]
+        meta["sql_count"] = sum(s["count"] for s in meta.get("sql", []))
+        meta.pop("sql", None)
+        report.append(meta)
+    report.sort(key=lambda m: m["duration_ms"], reverse=True)
+    return report[:limit]
@@ -0,0 +1,1028 @@
+# storage.py
+"""
+pings / premium_devices / スケッチの読み書きをまとめたストレージ層。
+
+- SQLiteStorage: 今までどおりの SQLite（シャーディング対応）
+- MemoryStorage: dict + deque だけで持つインメモリ版（テスト・ベンチ用。ディスクI/Oなし）
+
+app.py のルートは SQL を直接書かずに、ここのメソッドだけを呼ぶ。
+STORAGE_ENGINE=memory にすれば API 全体がインメモリで動く。
+"""
+import hashlib
+import heapq
+import os
+import sqlite3
+import threading
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+from hll import HyperLogLog
+
+# スケッチの時間バケット幅（分）。窓の始まりはこの単位で切り下げになる
+SKETCH_BUCKET_MINUTES = 10
+
+# pings の列（エクスポートもこの順で出す）
+PING_COLUMNS = [
+    "id", "device_id", "status", "region_code", "city_name",
+    "area_code", "lat", "lng", "message", "created_at",
+]
+
+# count_by で GROUP BY に使ってよい列
+GROUP_COLUMNS = {"region_code", "status", "city_name", "lat", "lng"}
+
+# start_trace() 中のスレッドが持つ「実行した SQL の記録先」
+_trace_local = threading.local()
+
+# 生きている SQLiteStorage（fork 後にプールと接続を捨てるため）。
+# register_at_fork は取り消せないので、インスタンスごとではなくここで1回だけ登録する
+_live_sqlite_storages = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for storage in list(_live_sqlite_storages):
+        storage._reset_pool()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class _TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        conn = self.connection
+        conn.statements.append((conn.shard, sql, len(parameters)))
+        return super().execute(sql, parameters)
+
+
+class _TracedConnection(sqlite3.Connection):
+    """
+    トレース中だけ使う接続。execute した SQL を「? のまま」と引数の数で記録する
+    （set_trace_callback だと値が埋め込まれた SQL になり、device_id やメッセージが残るうえ
+    同じ文をまとめられない）。
+    """
+
+    shard = None
+    statements = None
+
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def sketch_bucket_start(dt: datetime) -> str:
+    """dt を SKETCH_BUCKET_MINUTES 単位で切り下げた ISO 文字列"""
+    minute = dt.minute - dt.minute % SKETCH_BUCKET_MINUTES
+    return dt.replace(minute=minute, second=0, microsecond=0).isoformat()
+
+
+def _check_group_columns(columns):
+    for c in columns:
+        if c not in GROUP_COLUMNS:
+            raise ValueError(f"cannot group by {c}")
+
+
+class Storage(ABC):
+    """
+    ストレージのインターフェース（@abstractmethod は各エンジンで必ず実装する）。
+    ping は {"device_id", "status", "region_code", "city_name", "area_code",
+             "lat", "lng", "message"} の dict で渡す。
+    """
+
+    @abstractmethod
+    def init(self):
+        """テーブル作成など（起動時に1回）"""
+
+    @abstractmethod
+    def upsert_ping(self, ping: dict, now: datetime):
+        """device_id ごとに1件だけ持つ（あれば上書き）。スケッチも更新する"""
+
+    @abstractmethod
+    def count_by(self, columns, since_iso=None, with_location=False):
+        """columns ごとの件数を [(col1, col2, ..., count), ...] で返す"""
+
+    @abstractmethod
+    def map_points(self, since_iso: str, limit: int):
+        """
+        lat/lng ありの ping を新しい順に limit 件（dict のリスト）。
+        id はシャードごとの連番なので、各行に "shard"（非シャード時は None）もつける
+        """
+
+    @abstractmethod
+    def messages_by_area(self, area_code: str, since_iso: str, limit: int):
+        """area_code のメッセージ付き ping を新しい順に limit 件（dict のリスト）"""
+
+    @abstractmethod
+    def load_sketches(self, bucket_from: str, region_codes=None, area_codes=None):
+        """
+        bucket_from 以降のスケッチを [(region_code, registers), ...] で返す。
+        area_codes なしなら (region_code, バケット) ごとのまとめを返すので、件数は
+        region 数 × バケット数で済む（エリアのセル数によらない）
+        """
+
+    @abstractmethod
+    def iter_pings(self, since_iso=None, until_iso=None, region_codes=None,
+                   statuses=None, page_size=1000):
+        """
+        (created_at, id) 昇順で ping の dict を1件ずつ返す。
+        id はシャードごとの連番なので、各行に "shard"（非シャード時は None）もつける。
+        (created_at, id) を進めながら読むので、読んでいる間に上書きされた端末は
+        新しい created_at のところでもう一度出てくることがある（1端末1行にはならない）
+        """
+
+    @abstractmethod
+    def delete_before(self, cutoff_iso: str, bucket_cutoff: str):
+        """古い ping とスケッチを消して (消した ping 数, 消したスケッチ数) を返す"""
+
+    @abstractmethod
+    def is_premium(self, device_id: str) -> bool:
+        """プレミアム端末か（登録が無ければ False）"""
+
+    @abstractmethod
+    def premium_device_ids(self):
+        """プレミアム端末の device_id 一覧（キャッシュのウォームアップ用）"""
+
+    @abstractmethod
+    def set_premium(self, device_id: str, is_premium: bool):
+        """プレミアムの ON/OFF（無ければ作る）"""
+
+    @abstractmethod
+    def premium_version(self):
+        """set_premium のたびに変わる値（PremiumCache の作り直し判定用。毎回呼ばれるので軽いこと）"""
+
+    # --- プロファイル用（SQL を使わないエンジンは何もしない） ---
+
+    def start_trace(self):
+        """このスレッドで以降に実行される SQL を記録しはじめる"""
+
+    def stop_trace(self):
+        """記録を止めて [(shard, プレースホルダのままの sql, 引数の数), ...] を返す"""
+        return []
+
+    def explain(self, shard, sql: str, param_count: int = 0):
+        """sql の EXPLAIN QUERY PLAN（detail 列のリスト）"""
+        return []
+
+
+# --- SQLite ------------------------------------------------------
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite 版。シャーディング:
+      shard_mode=""        … db_path 1本（デフォルト）
+      shard_mode="region"  … region_code ごとに pings_v2_<region>.db（shard_regions + other）
+      shard_mode="device"  … device_id のハッシュで pings_v2_d0.db〜d{shard_count-1}.db
+    premium_devices は書き込みが少ないので、常に db_path 側に置く。
+    シャード時は各ファイルを WAL にして、書き込み用の接続をスレッドごとに使い回す（_writer）。
+    region モードでは「端末がいまどのシャードにいるか」を db_path 側の device_shard に持つ。
+    シャードの行を UPDATE できた ping は device_shard を見ないので、メインDBに触るのは
+    新規の端末と region が変わった端末だけ。
+    既存の pings_v2.db（非シャード時の pings）はシャードへ移さないので、
+    シャードを有効にした時点で読み取りからは見えなくなる（必要なら export-pings で移す）。
+    """
+
+    def __init__(self, db_path: str, shard_mode: str = "", shard_count: int = 4,
+                 shard_regions=()):
+        self.db_path = db_path
+        self.shard_mode = shard_mode
+        self.shard_count = shard_count
+        self.shard_regions = list(shard_regions)
+        # scatter_query 用のスレッドプール（遅延生成）。
+        # master で作ったプールのスレッドは fork 先に引き継がれないので、子では作り直す
+        self._pool = None
+        # シャード時の書き込み用接続（スレッドごとに開きっぱなし。_writer を参照）
+        self._writers = threading.local()
+        _live_sqlite_storages.add(self)
+
+    def _reset_pool(self):
+        # プールのスレッドも SQLite の接続も fork 先では使えないので捨てる
+        self._pool = None
+        self._writers = threading.local()
+
+    # --- 接続・シャード ---
+
+    def _connect(self, path: str, shard):
+        statements = getattr(_trace_local, "statements", None)
+        if statements is None:
+            conn = sqlite3.connect(path)
+        else:
+            conn = sqlite3.connect(path, factory=_TracedConnection)
+            conn.shard = shard
+            conn.statements = statements
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get_db(self):
+        return self._connect(self.db_path, None)
+
+    def shard_keys(self):
+        """今のモードでのシャード一覧（非シャード時は [None] = db_path）"""
+        if self.shard_mode == "region":
+            return self.shard_regions + ["other"]
+        if self.shard_mode == "device":
+            return [f"d{i}" for i in range(self.shard_count)]
+        return [None]
+
+    def shard_for_ping(self, region_code: str, device_id: str):
+        """この ping を書き込むシャード"""
+        if self.shard_mode == "region":
+            return region_code if region_code in self.shard_regions else "other"
+        if self.shard_mode == "device":
+            digest = hashlib.blake2b(device_id.encode("utf-8"), digest_size=8).digest()
+            return f"d{int.from_bytes(digest, 'big') % self.shard_count}"
+        return None
+
+    def shards_for_regions(self, region_codes):
+        """region_code で絞れる読み取りは、region モードなら該当シャードだけ見る"""
+        if self.shard_mode == "region" and region_codes:
+            return sorted({self.shard_for_ping(r, "") for r in region_codes})
+        return self.shard_keys()
+
+    def _shard_path(self, shard) -> str:
+        return os.path.join(os.path.dirname(self.db_path), f"pings_v2_{shard}.db")
+
+    def get_shard_db(self, shard):
+        if shard is None:
+            return self.get_db()
+        return self._connect(self._shard_path(shard), shard)
+
+    @contextmanager
+    def _writer(self, shard):
+        """
+        書き込み用の接続。シャード時（WAL）はスレッドごとに開きっぱなしにして使い回す。
+        WAL は最後の接続を閉じるたびにチェックポイントと -wal の削除が走るので、
+        1書き込みごとに開け閉めすると WAL にした意味がなくなる。
+        synchronous=NORMAL なのでプロセスが落ちても消えないが、OS ごと落ちると直近の数件は失うことがある。
+        非シャード時とトレース中は今までどおり毎回開いて閉じる。
+        """
+        if not self.shard_mode or getattr(_trace_local, "statements", None) is not None:
+            conn = self.get_shard_db(shard)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+
+        conns = getattr(self._writers, "conns", None)
+        if conns is None:
+            conns = self._writers.conns = {}
+        conn = conns.get(shard)
+        if conn is None:
+            conn = conns[shard] = self.get_shard_db(shard)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def query_shard(self, shard, sql: str, params=()):
+        conn = self.get_shard_db(shard)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def scatter_query(self, sql: str, params=(), shards=None, with_shard=False):
+        """
+        同じ SELECT を各シャードに並列で投げて、行をまとめて返す。
+        sqlite3 はクエリ中 GIL を離すのでスレッドで十分並列になる。
+        with_shard=True なら [(shard, row), ...] で返す。
+        """
+        if shards is None:
+            shards = self.shard_keys()
+        if len(shards) == 1:
+            rows = self.query_shard(shards[0], sql, params)
+            return [(shards[0], row) for row in rows] if with_shard else rows
+
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=len(self.shard_keys()))
+        # トレース中ならプールのスレッドにも記録先を引き継ぐ
+        statements = getattr(_trace_local, "statements", None)
+        futures = [
+            self._pool.submit(self._query_shard_traced, statements, s, sql, params)
+            for s in shards
+        ]
+        rows = []
+        for shard, future in zip(shards, futures):
+            if with_shard:
+                rows.extend((shard, row) for row in future.result())
+            else:
+                rows.extend(future.result())
+        return rows
+
+    def _query_shard_traced(self, statements, shard, sql: str, params):
+        _trace_local.statements = statements
+        try:
+            return self.query_shard(shard, sql, params)
+        finally:
+            _trace_local.statements = None
+
+    # --- プロファイル用 ---
+
+    def start_trace(self):
+        _trace_local.statements = []
+
+    def stop_trace(self):
+        statements = getattr(_trace_local, "statements", None) or []
+        _trace_local.statements = None
+        return statements
+
+    def explain(self, shard, sql: str, param_count: int = 0):
+        conn = self.get_shard_db(shard)
+        try:
+            # 値は残していないので NULL で埋める（プランはほぼ値に依らない）
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * param_count).fetchall()
+        finally:
+            conn.close()
+        return [row["detail"] for row in rows]
+
+    # --- スキーマ ---
+
+    def _init_ping_tables(self, cur):
+        """pings 系のテーブル（シャードごとに持つもの）"""
+        # --- pings テーブル（既存） ---
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT,
+                status TEXT,
+                region_code TEXT,
+                city_name TEXT,
+                area_code TEXT,
+                lat REAL,
+                lng REAL,
+                message TEXT,
+                created_at TEXT
+            )
+            """
+        )
+        # エクスポートのキーセットページング (created_at, id) と直近N分の絞り込み用
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pings_created_at_id ON pings (created_at, id)"
+        )
+        # upsert の「この端末の行はあるか」と、シャード移動時の DELETE 用
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pings_device_id ON pings (device_id)"
+        )
+
+        # --- ユニーク端末数用の HyperLogLog スケッチ ---
+        # (region_code, area_code, bucket_start) ごとに 2**p バイトの registers を持つ
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS device_sketches (
+                region_code TEXT NOT NULL,
+                area_code TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                registers BLOB NOT NULL,
+                PRIMARY KEY (region_code, area_code, bucket_start)
+            )
+            """
+        )
+        # 上の region ごとのまとめ（エリア指定なしの窓集計は「バケット数」回の merge で済む）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS region_sketches (
+                region_code TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                registers BLOB NOT NULL,
+                PRIMARY KEY (region_code, bucket_start)
+            )
+            """
+        )
+        self._backfill_region_sketches(cur)
+
+    def _backfill_region_sketches(self, cur):
+        """region_sketches が無かった頃の DB なら device_sketches から作る（起動時に1回）"""
+        if cur.execute("SELECT 1 FROM region_sketches LIMIT 1").fetchone():
+            return
+        rollups = {}
+        for region_code, bucket, registers in cur.execute(
+            "SELECT region_code, bucket_start, registers FROM device_sketches"
+        ).fetchall():
+            sketch = HyperLogLog.from_bytes(registers)
+            key = (region_code, bucket)
+            if key in rollups:
+                rollups[key].merge(sketch)
+            else:
+                rollups[key] = sketch
+        cur.executemany(
+            "INSERT INTO region_sketches (region_code, bucket_start, registers) VALUES (?, ?, ?)",
+            [(r, b, sketch.to_bytes()) for (r, b), sketch in rollups.items()],
+        )
+
+    def init(self):
+        conn = self.get_db()
+        cur = conn.cursor()
+
+        self._init_ping_tables(cur)
+
+        # --- ★ 追加：プレミアム端末テーブル ---
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS premium_devices (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT UNIQUE,
+                is_premium INTEGER NOT NULL DEFAULT 0,
+                note TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            """
+        )
+
+        # --- region シャードでの端末 → シャードの対応（1端末1行） ---
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS device_shard (
+                device_id TEXT PRIMARY KEY,
+                shard TEXT NOT NULL
+            )
+            """
+        )
+
+        conn.commit()
+        conn.close()
+
+        # シャードモードなら各シャードにも pings 系テーブルを作る。
+        # シャード（と device_shard を持つ db_path）は WAL にして、
+        # 書き込み中も読み取り・device_shard の確認を止めないようにする（設定はファイルに残る）
+        for shard in self.shard_keys():
+            if shard is None:
+                continue
+            conn = self.get_shard_db(shard)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._init_ping_tables(conn.cursor())
+            conn.commit()
+            conn.close()
+        if self.shard_mode:
+            conn = self.get_db()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+
+    # --- 書き込み ---
+
+    def upsert_ping(self, ping: dict, now: datetime):
+        device_id = ping["device_id"]
+        shard = self.shard_for_ping(ping["region_code"], device_id)
+        if self.shard_mode != "region":
+            self._write_ping(shard, ping, now)
+            return
+
+        # region モードは端末が別シャードへ移りうる。
+        # このシャードに行があった（UPDATE で済んだ）なら持ち主はこのシャードのままなので、
+        # メインDBには触らない。ほとんどの ping はここで終わる
+        inserted = self._write_ping(shard, ping, now)
+        if inserted:
+            # 新規 / region が変わった / prune で対応が消えた
+            self._claim_device(device_id, shard)
+
+    def _claim_device(self, device_id: str, shard):
+        """
+        shard に書き終えた端末の持ち主を shard にして、前のシャード1つだけから消す。
+        シャードへの書き込みはロックの外で済ませてあるので、
+        device_shard の書き込みロックは SELECT + UPSERT の間だけ持つ。
+        同じ端末の取り合いは、後から確定させたほうが前の持ち主の行を消して勝つ
+        （消された側が次に書くときは INSERT になるので、またここで取り返す）。
+        """
+        with self._writer(None) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT shard FROM device_shard WHERE device_id = ?", (device_id,)
+            ).fetchone()
+            previous = row[0] if row else None
+            if previous != shard:
+                conn.execute(
+                    """
+                    INSERT INTO device_shard (device_id, shard) VALUES (?, ?)
+                    ON CONFLICT(device_id) DO UPDATE SET shard = excluded.shard
+                    """,
+                    (device_id, shard),
+                )
+            conn.commit()
+
+        if previous is not None and previous != shard:
+            self._delete_device(previous, device_id)
+
+    def _delete_device(self, shard, device_id: str):
+        with self._writer(shard) as conn:
+            conn.execute("DELETE FROM pings WHERE device_id = ?", (device_id,))
+            conn.commit()
+
+    def _write_ping(self, shard, ping: dict, now: datetime) -> bool:
+        """shard に1端末1行で書く。新しく INSERT したら True"""
+        now_iso = now.isoformat()
+        device_id = ping["device_id"]
+
+        values = (
+            ping["status"],
+            ping["region_code"],
+            ping["city_name"],
+            ping["area_code"],
+            ping["lat"],
+            ping["lng"],
+            ping["message"],
+            now_iso,
+        )
+        with self._writer(shard) as conn:
+            cur = conn.cursor()
+
+            # ★ device_id ごとに1レコードだけ持つ（UPDATE or INSERT）
+            cur.execute(
+                "SELECT id FROM pings WHERE device_id = ? LIMIT 1",
+                (device_id,),
+            )
+            row = cur.fetchone()
+            if row:
+                cur.execute(
+                    """
+                    UPDATE pings
+                    SET status = ?, region_code = ?, city_name = ?, area_code = ?,
+                        lat = ?, lng = ?, message = ?, created_at = ?
+                    WHERE id = ?
+                    """,
+                    values + (row["id"],),
+                )
+            else:
+                cur.execute(
+                    """
+                    INSERT INTO pings (
+                        status, region_code, city_name, area_code,
+                        lat, lng, message, created_at, device_id
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    values + (device_id,),
+                )
+
+            # 行数 = 端末数 は「1端末1行」前提なので、ユニーク数はスケッチ側でも数えておく
+            self._update_sketch(cur, ping["region_code"], ping["area_code"], device_id, now)
+
+            conn.commit()
+        return row is None
+
+    def _update_sketch(self, cur, region_code: str, area_code: str, device_id: str,
+                       now: datetime):
+        """該当バケットのスケッチ（セルと region のまとめ）に device_id を足す（commit は呼び出し側）"""
+        bucket = sketch_bucket_start(now)
+        self._add_to_sketch(cur, "device_sketches",
+                            {"region_code": region_code, "area_code": area_code,
+                             "bucket_start": bucket}, device_id)
+        self._add_to_sketch(cur, "region_sketches",
+                            {"region_code": region_code, "bucket_start": bucket}, device_id)
+
+    def _add_to_sketch(self, cur, table: str, key: dict, device_id: str):
+        cols = list(key)
+        cur.execute(
+            f"SELECT registers FROM {table} WHERE "
+            + " AND ".join(f"{c} = ?" for c in cols),
+            [key[c] for c in cols],
+        )
+        row = cur.fetchone()
+        sketch = HyperLogLog.from_bytes(row[0]) if row else HyperLogLog()
+
+        # レジスタが変わらなければ書き込み不要（同じ端末の連打はここで終わる）
+        if not sketch.add(device_id) and row:
+            return
+
+        cur.execute(
+            f"""
+            INSERT INTO {table} ({", ".join(cols)}, registers)
+            VALUES ({", ".join("?" * (len(cols) + 1))})
+            ON CONFLICT({", ".join(cols)}) DO UPDATE SET registers = excluded.registers
+            """,
+            [key[c] for c in cols] + [sketch.to_bytes()],
+        )
+
+    def delete_before(self, cutoff_iso: str, bucket_cutoff: str):
+        deleted_rows = 0
+        deleted_sketches = 0
+        for shard in self.shard_keys():
+            conn = self.get_shard_db(shard)
+            cur = conn.cursor()
+            cur.execute(
+                """
+                DELETE FROM pings
+                WHERE created_at < ?
+                """,
+                (cutoff_iso,),
+            )
+            deleted_rows += cur.rowcount
+            # スケッチも同じ期間で捨てる
+            cur.execute(
+                "DELETE FROM device_sketches WHERE bucket_start < ?",
+                (bucket_cutoff,),
+            )
+            deleted_sketches += cur.rowcount
+            cur.execute(
+                "DELETE FROM region_sketches WHERE bucket_start < ?",
+                (bucket_cutoff,),
+            )
+            conn.commit()
+            conn.close()
+
+        if self.shard_mode == "region":
+            self._prune_device_shard()
+        return deleted_rows, deleted_sketches
+
+    def _prune_device_shard(self):
+        """行が消えた端末の device_shard を片付ける（増え続けないように）"""
+        conn = self.get_db()
+        try:
+            for shard in self.shard_keys():
+                conn.execute("ATTACH DATABASE ? AS shard", (self._shard_path(shard),))
+                conn.execute(
+                    """
+                    DELETE FROM device_shard
+                    WHERE shard = ?
+                      AND NOT EXISTS (
+                        SELECT 1 FROM shard.pings p
+                        WHERE p.device_id = device_shard.device_id
+                      )
+                    """,
+                    (shard,),
+                )
+                conn.commit()
+                conn.execute("DETACH DATABASE shard")
+        finally:
+            conn.close()
+
+    # --- 読み取り ---
+
+    def count_by(self, columns, since_iso=None, with_location=False):
+        _check_group_columns(columns)
+        cols = ", ".join(columns)
+        where = []
+        params = []
+        if since_iso:
+            where.append("created_at >= ?")
+            params.append(since_iso)
+        if with_location:
+            where.append("lat IS NOT NULL AND lng IS NOT NULL")
+
+        sql = f"SELECT {cols}, COUNT(*) FROM pings"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" GROUP BY {cols}"
+
+        # シャードをまたいだ分を足し合わせる（最後の列がカウント）
+        merged = {}
+        for row in self.scatter_query(sql, params):
+            key = tuple(row[:-1])
+            merged[key] = merged.get(key, 0) + int(row[-1])
+        return [key + (count,) for key, count in merged.items()]
+
+    def map_points(self, since_iso: str, limit: int):
+        rows = self.scatter_query(
+            """
+            SELECT id, status, lat, lng, message, created_at
+            FROM pings
+            WHERE created_at >= ?
+              AND lat IS NOT NULL
+              AND lng IS NOT NULL
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            (since_iso, limit),
+            with_shard=True,
+        )
+        # シャードごとに LIMIT しているので、まとめて並べ直して切り詰める
+        rows = sorted(rows, key=lambda r: r[1]["created_at"], reverse=True)[:limit]
+        return [dict(row, shard=shard) for shard, row in rows]
+
+    def messages_by_area(self, area_code: str, since_iso: str, limit: int):
+        rows = self.scatter_query(
+            """
+            SELECT device_id, status, message, created_at
+            FROM pings
+            WHERE created_at >= ?
+              AND area_code = ?
+              AND message IS NOT NULL
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            (since_iso, area_code, limit),
+        )
+        rows = sorted(rows, key=lambda r: r["created_at"], reverse=True)[:limit]
+        return [dict(row) for row in rows]
+
+    def load_sketches(self, bucket_from: str, region_codes=None, area_codes=None):
+        # エリア指定がなければ region ごとのまとめだけ読む
+        table = "device_sketches" if area_codes else "region_sketches"
+        sql = f"SELECT region_code, registers FROM {table} WHERE bucket_start >= ?"
+        params = [bucket_from]
+        if region_codes:
+            sql += " AND region_code IN (%s)" % ",".join("?" * len(region_codes))
+            params.extend(region_codes)
+        if area_codes:
+            sql += " AND area_code IN (%s)" % ",".join("?" * len(area_codes))
+            params.extend(area_codes)
+        rows = self.scatter_query(sql, params, self.shards_for_regions(region_codes))
+        return [(r, bytes(registers)) for r, registers in rows]
+
+    def _iter_shard_pings(self, shard, since_iso, until_iso, region_codes, statuses,
+                          page_size):
+        """
+        1シャード分を (created_at, id) のキーセットページングで順に返す。
+        ページごとに接続を開き直すので、長い読み取りトランザクションで書き込みを止めない。
+        """
+        where = []
+        params = []
+        if since_iso:
+            where.append("created_at >= ?")
+            params.append(since_iso)
+        if until_iso:
+            where.append("created_at < ?")
+            params.append(until_iso)
+        if region_codes:
+            where.append("region_code IN (%s)" % ",".join("?" * len(region_codes)))
+            params.extend(region_codes)
+        if statuses:
+            where.append("status IN (%s)" % ",".join("?" * len(statuses)))
+            params.extend(statuses)
+
+        last_key = None
+        while True:
+            page_where = list(where)
+            page_params = list(params)
+            if last_key is not None:
+                page_where.append("(created_at, id) > (?, ?)")
+                page_params.extend(last_key)
+
+            sql = "SELECT %s FROM pings" % ", ".join(PING_COLUMNS)
+            if page_where:
+                sql += " WHERE " + " AND ".join(page_where)
+            sql += " ORDER BY created_at, id LIMIT ?"
+            page_params.append(page_size)
+
+            rows = self.query_shard(shard, sql, page_params)
+            for row in rows:
+                yield dict(row, shard=shard)
+            if len(rows) < page_size:
+                return
+            last_key = (rows[-1]["created_at"], rows[-1]["id"])
+
+    def iter_pings(self, since_iso=None, until_iso=None, region_codes=None,
+                   statuses=None, page_size=1000):
+        """全シャードを (created_at, id) 順にマージしながら1行ずつ返す"""
+        streams = [
+            self._iter_shard_pings(s, since_iso, until_iso, region_codes, statuses, page_size)
+            for s in self.shards_for_regions(region_codes)
+        ]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=lambda r: (r["created_at"], r["id"]))
+
+    # --- プレミアム ---
+
+    def is_premium(self, device_id: str) -> bool:
+        conn = self.get_db()
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT is_premium FROM premium_devices WHERE device_id = ?",
+            (device_id,),
+        )
+        row = cur.fetchone()
+        conn.close()
+
+        if not row:
+            return False
+        return bool(row[0])
+
+    def premium_device_ids(self):
+        conn = self.get_db()
+        rows = conn.execute(
+            "SELECT device_id FROM premium_devices WHERE is_premium = 1"
+        ).fetchall()
+        conn.close()
+        return [row[0] for row in rows]
+
+    def set_premium(self, device_id: str, is_premium: bool):
+        conn = self.get_db()
+        cur = conn.cursor()
+
+        # 既にあれば UPDATE、なければ INSERT （UPSERT）
+        cur.execute(
+            """
+            INSERT INTO premium_devices (device_id, is_premium)
+            VALUES (?, ?)
+            ON CONFLICT(device_id) DO UPDATE SET is_premium = excluded.is_premium
+            """,
+            (device_id, 1 if is_premium else 0),
+        )
+        conn.commit()
+        conn.close()
+        # commit の後に version を進める（先に進めると、古い集合を新しい version で覚えてしまう）
+        with open(self._premium_version_path(), "ab") as f:
+            f.write(b".")
+
+    def _premium_version_path(self) -> str:
+        return self.db_path + ".premium_version"
+
+    def premium_version(self):
+        """
+        db_path の横のファイルに set_premium のたびに1バイト足して、そのサイズを version にする。
+        DB に接続して SELECT するより stat 1回のほうがずっと軽い
+        """
+        try:
+            return os.stat(self._premium_version_path()).st_size
+        except FileNotFoundError:
+            return 0
+
+
+# --- インメモリ ---------------------------------------------------
+
+
+class MemoryStorage(Storage):
+    """
+    dict と deque だけで持つインメモリ版（プロセスが落ちたら消える）。
+      - pings:       {device_id: row}          … 1端末1行
+      - recent:      deque[(created_at, device_id)] … 書き込み順（= 時刻順）
+                     古いエントリは上書き済みのものも残るので、
+                     row["created_at"] と一致するものだけを有効とみなす
+      - by_area:     {area_code: {device_id}}  … メッセージ検索用
+      - sketches:    {(region_code, area_code, bucket_start): HyperLogLog}
+      - region_sketches: {(region_code, bucket_start): HyperLogLog} … 上の region ごとのまとめ
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.pings = {}
+        self.recent = deque()
+        self.by_area = {}
+        self.sketches = {}
+        self.region_sketches = {}
+        self.premium = {}
+        self._premium_version = 0
+
+    def init(self):
+        pass
+
+    def _is_live(self, created_at: str, device_id: str) -> bool:
+        row = self.pings.get(device_id)
+        return row is not None and row["created_at"] == created_at
+
+    def _iter_recent(self, since_iso):
+        """since_iso 以降の有効な行を新しい順に返す（ロックは呼び出し側）"""
+        for created_at, device_id in reversed(self.recent):
+            if since_iso and created_at < since_iso:
+                break
+            if self._is_live(created_at, device_id):
+                yield self.pings[device_id]
+
+    def _compact(self):
+        """上書きで死んだエントリが溜まりすぎたら recent を作り直す"""
+        if len(self.recent) > 2 * len(self.pings) + 1024:
+            self.recent = deque(
+                e for e in self.recent if self._is_live(e[0], e[1])
+            )
+
+    def upsert_ping(self, ping: dict, now: datetime):
+        now_iso = now.isoformat()
+        device_id = ping["device_id"]
+        with self._lock:
+            old = self.pings.get(device_id)
+            if old:
+                row_id = old["id"]
+                self.by_area.get(old["area_code"], set()).discard(device_id)
+            else:
+                row_id = self._next_id
+                self._next_id += 1
+
+            row = {c: ping.get(c) for c in PING_COLUMNS}
+            row["id"] = row_id
+            row["created_at"] = now_iso
+            self.pings[device_id] = row
+            self.recent.append((now_iso, device_id))
+            self.by_area.setdefault(row["area_code"], set()).add(device_id)
+
+            bucket = sketch_bucket_start(now)
+            for sketches, key in (
+                (self.sketches, (row["region_code"], row["area_code"], bucket)),
+                (self.region_sketches, (row["region_code"], bucket)),
+            ):
+                sketch = sketches.get(key)
+                if sketch is None:
+                    sketch = sketches[key] = HyperLogLog()
+                sketch.add(device_id)
+
+            self._compact()
+
+    def delete_before(self, cutoff_iso: str, bucket_cutoff: str):
+        deleted_rows = 0
+        with self._lock:
+            while self.recent and self.recent[0][0] < cutoff_iso:
+                created_at, device_id = self.recent.popleft()
+                if self._is_live(created_at, device_id):
+                    row = self.pings.pop(device_id)
+                    self.by_area.get(row["area_code"], set()).discard(device_id)
+                    deleted_rows += 1
+
+            old_keys = [k for k in self.sketches if k[2] < bucket_cutoff]
+            for k in old_keys:
+                del self.sketches[k]
+            for k in [k for k in self.region_sketches if k[1] < bucket_cutoff]:
+                del self.region_sketches[k]
+        return deleted_rows, len(old_keys)
+
+    def count_by(self, columns, since_iso=None, with_location=False):
+        _check_group_columns(columns)
+        counts = {}
+        with self._lock:
+            rows = self._iter_recent(since_iso) if since_iso else self.pings.values()
+            for row in rows:
+                if with_location and (row["lat"] is None or row["lng"] is None):
+                    continue
+                key = tuple(row[c] for c in columns)
+                counts[key] = counts.get(key, 0) + 1
+        return [key + (count,) for key, count in counts.items()]
+
+    def map_points(self, since_iso: str, limit: int):
+        result = []
+        with self._lock:
+            for row in self._iter_recent(since_iso):
+                if row["lat"] is None or row["lng"] is None:
+                    continue
+                point = {k: row[k] for k in ("id", "status", "lat", "lng", "message", "created_at")}
+                point["shard"] = None
+                result.append(point)
+                if len(result) >= limit:
+                    break
+        return result
+
+    def messages_by_area(self, area_code: str, since_iso: str, limit: int):
+        with self._lock:
+            rows = [
+                self.pings[d] for d in self.by_area.get(area_code, ())
+                if self.pings[d]["created_at"] >= since_iso
+                and self.pings[d]["message"] is not None
+            ]
+            rows.sort(key=lambda r: r["created_at"], reverse=True)
+            return [
+                {k: row[k] for k in ("device_id", "status", "message", "created_at")}
+                for row in rows[:limit]
+            ]
+
+    def load_sketches(self, bucket_from: str, region_codes=None, area_codes=None):
+        with self._lock:
+            if not area_codes:
+                return [
+                    (region_code, sketch.to_bytes())
+                    for (region_code, bucket), sketch in self.region_sketches.items()
+                    if bucket >= bucket_from
+                    and (not region_codes or region_code in region_codes)
+                ]
+            return [
+                (region_code, sketch.to_bytes())
+                for (region_code, area_code, bucket), sketch in self.sketches.items()
+                if bucket >= bucket_from
+                and (not region_codes or region_code in region_codes)
+                and area_code in area_codes
+            ]
+
+    def iter_pings(self, since_iso=None, until_iso=None, region_codes=None,
+                   statuses=None, page_size=1000):
+        # SQLite 版のようにキーセットページングでストリームはしない。
+        # 該当行のコピーをロック中に全部作って並べてから返すので、メモリは件数ぶん使う
+        # （page_size は無視。インメモリ版はテスト・ベンチ用の規模が前提）
+        with self._lock:
+            rows = [
+                dict(row, shard=None) for row in self.pings.values()
+                if (not since_iso or row["created_at"] >= since_iso)
+                and (not until_iso or row["created_at"] < until_iso)
+                and (not region_codes or row["region_code"] in region_codes)
+                and (not statuses or row["status"] in statuses)
+            ]
+        rows.sort(key=lambda r: (r["created_at"], r["id"]))
+        return iter(rows)
+
+    def is_premium(self, device_id: str) -> bool:
+        return self.premium.get(device_id, False)
+
+    def premium_device_ids(self):
+        return [d for d, flag in self.premium.items() if flag]
+
+    def set_premium(self, device_id: str, is_premium: bool):
+        with self._lock:
+            self.premium[device_id] = bool(is_premium)
+            self._premium_version += 1
+
+    def premium_version(self):
+        return self._premium_version
+
+
+def create_storage(engine: str, db_path: str, shard_mode: str = "", shard_count: int = 4,
+                   shard_regions=()) -> Storage:
+    """STORAGE_ENGINE の値からストレージを作る（sqlite / memory）"""
+    if engine == "memory":
+        return MemoryStorage()
+    if engine == "sqlite":
+        return SQLiteStorage(db_path, shard_mode, shard_count, shard_regions)
+    raise ValueError(f"unknown storage engine: {engine}")
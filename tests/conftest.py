@@ -0,0 +1,14 @@
+# tests/conftest.py
+"""
+app を import すると module の最後で create_app() が走るので、その前に
+本物の pings_v2.db を触らない設定にしておく（各テストは tmp_path で create_app し直す）。
+"""
+import os
+import sys
+import tempfile
+
+os.environ["STORAGE_ENGINE"] = "memory"
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="hereping-test-"), "pings_v2.db")
+os.environ["WARM_ON_STARTUP"] = "0"
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
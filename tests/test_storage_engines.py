@@ -0,0 +1,165 @@
+# tests/test_storage_engines.py
+"""
+同じ API 呼び出しを sqlite（シャードなし / region / device）と memory に投げて、
+レスポンスが一致することを確かめる。
+
+    python -m pytest -q tests
+"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as hereping
+
+TOKEN = hereping.ADMIN_SECRET
+
+
+class FakeDatetime(datetime):
+    """utcnow() を呼ぶたびに1秒進む時計（エンジン間で created_at を揃える）"""
+
+    current = datetime(2024, 1, 1, 12, 0, 0)
+
+    @classmethod
+    def utcnow(cls):
+        cls.current += timedelta(seconds=1)
+        return cls.current
+
+
+def make_client(monkeypatch, tmp_path, engine, shard_mode=""):
+    FakeDatetime.current = datetime(2024, 1, 1, 12, 0, 0)
+    monkeypatch.setattr(hereping, "datetime", FakeDatetime)
+    monkeypatch.setattr(hereping, "DB_PATH", str(tmp_path / "pings_v2.db"))
+    monkeypatch.setattr(hereping, "SHARD_MODE", shard_mode)
+    # 書いた直後の集計を比べたいのでキャッシュは切る
+    monkeypatch.setattr(hereping, "AGGREGATE_CACHE_TTL", 0)
+    return hereping.create_app(storage_engine=engine, warm=False).test_client()
+
+
+def post_ping(client, device_id, region_code, lat=None, lng=None, message=None):
+    res = client.post(
+        "/api/pings",
+        json={
+            "device_id": device_id,
+            "status": "awake" if device_id.endswith(("a", "c")) else "free",
+            "region_code": region_code,
+            "city_name": f"{region_code}-city",
+            "lat": lat,
+            "lng": lng,
+            "message": message,
+        },
+    )
+    assert res.status_code == 201
+
+
+def run_scenario(client):
+    """ping を入れて（上書き・region 移動・古い ping の削除を含む）各 API の結果を集める"""
+    for device_id in ("dev-a", "dev-b"):
+        res = client.post(
+            "/api/admin/set_premium_device",
+            json={"device_id": device_id, "is_premium": True, "token": TOKEN},
+        )
+        assert res.status_code == 200
+
+    # 2日前の ping（cleanup で消える）
+    post_ping(client, "dev-old", "kanto", 35.68, 139.76)
+    FakeDatetime.current += timedelta(days=2)
+
+    post_ping(client, "dev-a", "kanto", 35.68, 139.76, "hello")
+    post_ping(client, "dev-b", "kanto", 35.68, 139.76, "hi")
+    post_ping(client, "dev-c", "kansai")
+    post_ping(client, "dev-d", "kanto", 35.01, 135.77)
+    # 上書き（region も変わる）
+    post_ping(client, "dev-a", "kansai", 34.69, 135.50, "moved")
+    post_ping(client, "dev-b", "kanto", 35.68, 139.76, "again")
+
+    calls = [
+        ("/api/pings/summary", True),
+        ("/api/pings/summary_status", True),
+        ("/api/pings/summary_status?minutes=100000", True),
+        ("/api/pings/map", True),
+        ("/api/pings/map_total", True),
+        (f"/api/admin/ping_stats?token={TOKEN}", True),
+        ("/api/pings/grid_status", True),
+        ("/api/pings/unique_devices?minutes=100000", False),
+        ("/api/pings/map_points", False),
+        ("/api/messages/by_grid?device_id=dev-a&lat=35.68&lng=139.76", False),
+        ("/api/messages/by_grid?device_id=dev-a&lat=34.69&lng=135.50", False),
+        (f"/api/admin/export_pings?token={TOKEN}&format=ndjson&page_size=2", False),
+        (f"/api/admin/export_pings?token={TOKEN}&format=csv&region_code=kanto", False),
+        (f"/api/admin/cleanup_old_pings?token={TOKEN}&days=1", False),
+        (f"/api/admin/export_pings?token={TOKEN}&format=columnar", False),
+        ("/api/pings/map_total", True),
+    ]
+    results = []
+    for url, unordered in calls:
+        res = client.get(url)
+        body = res.get_json() if res.is_json else res.get_data(as_text=True)
+        results.append((url, res.status_code, normalize(body, unordered)))
+    return results
+
+
+def normalize(body, unordered):
+    """件数系は並び順が決まっていないので、リストを並べ替えて比べる"""
+    if not unordered:
+        return body
+    if isinstance(body, list):
+        return sorted((normalize(v, True) for v in body), key=json.dumps)
+    if isinstance(body, dict):
+        return {k: normalize(v, True) for k, v in body.items()}
+    return body
+
+
+def strip_shard_fields(results):
+    """シャードごとに id が振られる（shard 列もつく）ので、シャード時は id と shard を除いて比べる"""
+    def strip(body):
+        if isinstance(body, list):
+            return [strip(v) for v in body]
+        if isinstance(body, dict):
+            return {k: strip(v) for k, v in body.items() if k not in ("id", "shard")}
+        if isinstance(body, str) and body.startswith(("{", "id,")):
+            lines = body.splitlines()
+            if body.startswith("{"):
+                return [strip(json.loads(line)) for line in lines]
+            return [line.split(",", 1)[1].rsplit(",", 1)[0] for line in lines]
+        return body
+
+    return [(url, status, strip(body)) for url, status, body in results]
+
+
+@pytest.mark.parametrize("shard_mode", ["", "region", "device"])
+def test_sqlite_matches_memory(monkeypatch, tmp_path, shard_mode):
+    expected = run_scenario(make_client(monkeypatch, tmp_path / "memory", "memory"))
+    (tmp_path / "sqlite").mkdir()
+    actual = run_scenario(make_client(monkeypatch, tmp_path / "sqlite", "sqlite", shard_mode))
+
+    if shard_mode:
+        expected, actual = strip_shard_fields(expected), strip_shard_fields(actual)
+    for (url, *exp), (_, *act) in zip(expected, actual):
+        assert act == exp, url
+
+
+def test_scenario_sanity(monkeypatch, tmp_path):
+    """比較の前提（上書き後は1端末1行・cleanup で古い ping が消える）"""
+    results = dict(
+        (url, body)
+        for url, _status, body in run_scenario(make_client(monkeypatch, tmp_path, "memory"))
+    )
+    total = results["/api/pings/map_total"]
+    assert sum(r["count"] for r in total) == 4  # a は kansai に移動、old は削除済み
+    assert results[f"/api/admin/cleanup_old_pings?token={TOKEN}&days=1"]["deleted"] == 1
+
+    moved = results["/api/messages/by_grid?device_id=dev-a&lat=34.69&lng=135.50"]
+    assert [m["message"] for m in moved["messages"]] == ["moved"]
+    old_area = results["/api/messages/by_grid?device_id=dev-a&lat=35.68&lng=139.76"]
+    assert [m["device_id"] for m in old_area["messages"]] == ["dev-b"]
+
+
+def test_export_ids_unique_with_shard(monkeypatch, tmp_path):
+    """region シャードでは id が重なるので、(shard, id) で一意になること"""
+    client = make_client(monkeypatch, tmp_path, "sqlite", "region")
+    post_ping(client, "dev-a", "kanto", 35.68, 139.76)
+    post_ping(client, "dev-b", "kansai", 34.69, 135.50)
+    res = client.get(f"/api/admin/export_pings?token={TOKEN}&format=ndjson")
+    rows = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert [(r["shard"], r["id"]) for r in rows] == [("kanto", 1), ("kansai", 1)]